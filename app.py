@@ -1,28 +1,44 @@
-import json
+import cProfile
+import hmac
 import os
-import re
+import pstats
 import time
 import base64
-from datetime import datetime, timedelta
-from io import BytesIO, StringIO
-from typing import Optional
-from zoneinfo import ZoneInfo
+import uuid
+from io import StringIO
 
-import altair as alt
 import pandas as pd
 import requests
 import streamlit as st
-from pypdf import PdfReader
 from streamlit_lottie import st_lottie
 
+from pipeline import (
+    CHART_WINDOWS,
+    METRICS_PORT,
+    SESSION_IDLE_TIMEOUT,
+    STAGE_PAYLOADS,
+    TIME_PER_ORDER_MIN,
+    SessionPayloadStore,
+    berlin_now_hour_naive,
+    berlin_now_naive,
+    build_orders_chart_spec,
+    convert_pdf,
+    format_bytes,
+    get_metrics_registry,
+    get_payload_store,
+    load_global_stats,
+    start_metrics_server,
+    track_stage,
+    validate_pdf_bytes,
+    write_metrics_file,
+)
+
 st.set_page_config(page_title="Etsy2JTL", layout="wide")
 
 UPLOAD_DELAY = 25
-STATS_FILE = "antsy_global_stats.json"
-TIME_PER_ORDER_MIN = 2.5
-PDF_MAGIC_BYTES = b"%PDF"
-HISTORY_HOURS = 12
-BERLIN_TZ = ZoneInfo("Europe/Berlin")
+PROFILE_DIR = "antsy_profiles"
+PROFILE_TOP_FUNCTIONS = 25
+PROFILE_HISTORY_RUNS = 5
 
 
 def inject_styles():
@@ -479,310 +495,388 @@ def format_duration(minutes: float) -> str:
     return f"{hours}h {mins}m"
 
 
-def berlin_now_naive() -> datetime:
-    # Keep timestamps in Berlin local time while storing naive hour keys.
-    return datetime.now(BERLIN_TZ).replace(tzinfo=None)
-
-
-def berlin_now_hour_naive() -> datetime:
-    return berlin_now_naive().replace(minute=0, second=0, microsecond=0)
-
-
 def validate_pdf(uploaded_file) -> tuple[bool, str]:
-    generic_invalid_msg = "Datei abgelehnt. Nur gültige Etsy-Bestellbestätigungen sind erlaubt."
+    is_valid, error_msg, _ = validate_pdf_bytes(uploaded_file.getvalue(), uploaded_file.type)
+    return is_valid, error_msg
 
-    if uploaded_file.type != "application/pdf":
-        return False, generic_invalid_msg
 
-    try:
-        file_bytes = uploaded_file.getvalue()
-        if not file_bytes.startswith(PDF_MAGIC_BYTES):
-            return False, generic_invalid_msg
+def render_hourly_orders_chart(stats: dict):
+    window = st.session_state.get("chart_window", next(iter(CHART_WINDOWS)))
+    if CHART_WINDOWS[window][0] == "hourly":
+        st.markdown("#### Bestellungen pro Stunde (letzte 12h, Berlin)")
+    else:
+        st.markdown(f"#### Bestellungen pro Tag (letzte {window}, Berlin)")
+
+    st.radio(
+        "Zeitraum",
+        list(CHART_WINDOWS),
+        key="chart_window",
+        horizontal=True,
+        label_visibility="collapsed",
+    )
+    spec = build_orders_chart_spec(
+        window,
+        berlin_now_hour_naive().strftime("%Y-%m-%d %H:00"),
+        int(stats.get("stats_version", 0)),
+        stats,
+    )
+    st.vega_lite_chart(spec, use_container_width=True)
 
-        reader = PdfReader(BytesIO(file_bytes))
-        if len(reader.pages) == 0:
-            return False, generic_invalid_msg
 
-        scan_text = "\n".join((page.extract_text() or "") for page in reader.pages)
-        text_lower = scan_text.lower()
+def mark_csv_downloaded(payload_store: SessionPayloadStore, session_id: str):
+    # Once downloaded the CSV only needs to stay available for a repeat
+    # download, so it moves to the spill directory and the button (with the
+    # media manager's copy) is no longer rendered.
+    payload_store.spill(session_id, "csv")
+    payload_store.mark_exported(session_id, "csv", False)
+    st.session_state.csv_downloaded = True
 
-        order_marker_ok = bool(
-            re.search(r"bestellung\s+nr\.\s*\d+", text_lower)
-            or re.search(r"order\s*#\s*\d+", text_lower)
-        )
-        etsy_brand_ok = "etsy" in text_lower
-        payment_ok = "etsy payments" in text_lower or "paypal" in text_lower
-        shipping_ok = "versand an" in text_lower or "ship to" in text_lower
-        total_ok = "gesamtsumme der bestellung" in text_lower or "order total" in text_lower
-        origami_ok = "origami" in text_lower and "konfetti" in text_lower
 
-        if order_marker_ok and etsy_brand_ok and payment_ok and shipping_ok and total_ok and origami_ok:
-            return True, ""
-        return False, generic_invalid_msg
-    except Exception:
-        return False, generic_invalid_msg
+def render_memory_usage(payload_store: SessionPayloadStore, session_id: str):
+    if not debug_mode_enabled():
+        return
 
+    usage = payload_store.usage(session_id)
+    with st.expander("Speichernutzung"):
+        st.caption(
+            f"Diese Sitzung: {format_bytes(usage['session_memory_bytes'])} im Speicher "
+            f"(davon {format_bytes(usage['session_exported_bytes'])} Download-Kopien), "
+            f"{format_bytes(usage['session_spilled_bytes'])} ausgelagert"
+        )
+        st.caption(
+            f"Alle Sitzungen ({usage['sessions']}): {format_bytes(usage['global_memory_bytes'])} im Speicher "
+            f"(davon {format_bytes(usage['global_exported_bytes'])} Download-Kopien), "
+            f"{format_bytes(usage['global_spilled_bytes'])} ausgelagert"
+        )
+        st.caption(f"Prozess (RSS): {format_bytes(usage['process_rss_bytes'])}")
 
-def trim_hourly_history(history: dict, now_hour: Optional[datetime] = None) -> dict:
-    if not isinstance(history, dict):
-        return {}
 
-    reference_hour = now_hour or berlin_now_hour_naive()
-    trimmed: dict[str, int] = {}
+def debug_mode_enabled() -> bool:
+    # Admin-only: the DEBUG_TOKEN secret must be set and passed as ?debug=.
+    try:
+        debug_token = st.secrets.get("DEBUG_TOKEN")
+    except FileNotFoundError:
+        return False
+    requested_token = st.query_params.get("debug", "")
+    return bool(debug_token) and hmac.compare_digest(str(requested_token), str(debug_token))
 
-    for hour_key, value in history.items():
-        try:
-            hour_dt = datetime.strptime(hour_key, "%Y-%m-%d %H:00")
-            count = max(int(value), 0)
-        except (TypeError, ValueError):
-            continue
 
-        hours_ago = (reference_hour - hour_dt).total_seconds() / 3600
-        if 0 <= hours_ago < HISTORY_HOURS:
-            trimmed[hour_key] = count
+def start_run_profile():
+    st.session_state.run_profile = None
 
-    return trimmed
+    if not debug_mode_enabled():
+        return
 
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        return
+    st.session_state.run_profile = {
+        "profiler": profiler,
+        "stage": st.session_state.get("stage", "upload"),
+        "started_at": berlin_now_naive(),
+        "stages": [],
+        "wall_start": time.perf_counter(),
+        "cpu_start": time.thread_time(),
+    }
+
+
+def finish_run_profile(run_profile: dict) -> dict:
+    # Idempotent: the panel finishes the current run early to display it, and
+    # the script's finally block finishes whatever is still running.
+    if "summary" not in run_profile:
+        run_profile["profiler"].disable()
+        run_profile["summary"] = {
+            "label": f"{run_profile['started_at'].strftime('%H:%M:%S')} {run_profile['stage']}",
+            "started_at": run_profile["started_at"],
+            "stage": run_profile["stage"],
+            "wall": time.perf_counter() - run_profile["wall_start"],
+            "cpu": time.thread_time() - run_profile["cpu_start"],
+            "stages": list(run_profile["stages"]),
+            "stats": pstats.Stats(run_profile["profiler"]),
+        }
+    return run_profile["summary"]
 
-def build_hourly_history_df(stats: dict) -> pd.DataFrame:
-    now_hour = berlin_now_hour_naive()
-    history = trim_hourly_history(stats.get("hourly_orders", {}), now_hour)
 
-    rows = []
-    for offset in range(HISTORY_HOURS - 1, -1, -1):
-        hour_dt = now_hour - timedelta(hours=offset)
-        hour_key = hour_dt.strftime("%Y-%m-%d %H:00")
-        rows.append(
-            {
-                "Stunde": hour_dt.strftime("%H:%M"),
-                "Bestellungen": int(history.get(hour_key, 0)),
-            }
-        )
-    return pd.DataFrame(rows)
+def stop_run_profile():
+    # Called from the script's finally block. Runs ending in st.rerun() or
+    # st.stop() (the convert click, every processing run) never reach the
+    # panel, so their profile is kept for the next run to show. On Python
+    # 3.12+ a profiler left enabled would also stay active process-wide.
+    run_profile = st.session_state.get("run_profile")
+    if run_profile is None:
+        return
+    st.session_state.run_profile = None
 
+    summary = finish_run_profile(run_profile)
+    history = st.session_state.get("profile_history", [])
+    st.session_state.profile_history = (history + [summary])[-PROFILE_HISTORY_RUNS:]
 
-def render_hourly_orders_chart(stats: dict):
-    history_df = build_hourly_history_df(stats)
-
-    chart = (
-        alt.Chart(history_df)
-        .mark_bar(size=24, cornerRadiusTopLeft=6, cornerRadiusTopRight=6)
-        .encode(
-            x=alt.X("Stunde:N", axis=alt.Axis(title=None, labelAngle=0)),
-            y=alt.Y("Bestellungen:Q", axis=alt.Axis(title="Bestellungen"), scale=alt.Scale(domainMin=0)),
-            color=alt.value("#2FD38A"),
-            tooltip=[
-                alt.Tooltip("Stunde:N", title="Stunde"),
-                alt.Tooltip("Bestellungen:Q", title="Bestellungen"),
-            ],
-        )
-        .properties(height=230)
-        .configure_view(strokeWidth=0)
-        .configure_axis(
-            labelColor="#eafff2",
-            titleColor="#eafff2",
-            gridColor="rgba(234, 255, 242, 0.16)",
-            domainColor="rgba(234, 255, 242, 0.22)",
-            tickColor="rgba(234, 255, 242, 0.22)",
-        )
+    if st.session_state.get("profile_dump_enabled"):
+        file_name = f"run-{summary['started_at'].strftime('%Y%m%d-%H%M%S-%f')}-{summary['stage']}.prof"
+        try:
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            summary["stats"].dump_stats(os.path.join(PROFILE_DIR, file_name))
+        except IOError:
+            pass
+
+
+def render_run_profile(summary: dict):
+    stages_df = pd.DataFrame(
+        [
+            {"Stage": stage, "Wall ms": round(wall * 1000, 2), "CPU ms": round(cpu * 1000, 2)}
+            for stage, wall, cpu in summary["stages"]
+        ],
+        columns=["Stage", "Wall ms", "CPU ms"],
     )
 
-    st.markdown("#### Bestellungen pro Stunde (letzte 12h, Berlin)")
-    st.altair_chart(chart, use_container_width=True)
-
-
-def update_global_stats(order_count: int):
-    stats = load_global_stats()
-    stats["total_orders"] = stats.get("total_orders", 0) + order_count
-    stats["total_time_saved"] = stats.get("total_time_saved", 0) + (order_count * TIME_PER_ORDER_MIN)
-    stats["total_conversions"] = stats.get("total_conversions", 0) + 1
-
-    current_hour = berlin_now_hour_naive()
-    current_hour_key = current_hour.strftime("%Y-%m-%d %H:00")
-    hourly_history = trim_hourly_history(stats.get("hourly_orders", {}), current_hour)
-    hourly_history[current_hour_key] = hourly_history.get(current_hour_key, 0) + order_count
-    stats["hourly_orders"] = trim_hourly_history(hourly_history, current_hour)
-
-    try:
-        with open(STATS_FILE, "w", encoding="utf-8") as f:
-            json.dump(stats, f, indent=2)
-    except IOError:
-        pass
-
+    hot_functions = sorted(summary["stats"].stats.items(), key=lambda item: item[1][2], reverse=True)
+    functions_df = pd.DataFrame(
+        [
+            {
+                "Funktion": f"{func_name} ({os.path.basename(file_name)}:{line_no})",
+                "Aufrufe": call_count,
+                "Eigenzeit ms": round(own_time * 1000, 2),
+                "Gesamtzeit ms": round(cumulative_time * 1000, 2),
+            }
+            for (file_name, line_no, func_name), (_, call_count, own_time, cumulative_time, _) in hot_functions[
+                :PROFILE_TOP_FUNCTIONS
+            ]
+        ],
+        columns=["Funktion", "Aufrufe", "Eigenzeit ms", "Gesamtzeit ms"],
+    )
 
-def load_global_stats() -> dict:
-    if os.path.exists(STATS_FILE):
-        try:
-            with open(STATS_FILE, "r", encoding="utf-8") as f:
-                stats = json.load(f)
-                stats["hourly_orders"] = trim_hourly_history(stats.get("hourly_orders", {}))
-                return stats
-        except (json.JSONDecodeError, IOError):
-            return {}
-    return {"total_orders": 0, "total_time_saved": 0, "total_conversions": 0, "hourly_orders": {}}
+    st.caption(f"{summary['wall'] * 1000:.0f} ms Wall, {summary['cpu'] * 1000:.0f} ms CPU")
+    st.markdown("##### Stages")
+    st.dataframe(stages_df, use_container_width=True, hide_index=True)
+    st.markdown("##### Top-Funktionen (Eigenzeit)")
+    st.dataframe(functions_df, use_container_width=True, hide_index=True)
 
 
-lottie_loading = load_lottieurl(
-    "https://lottie.host/c10aad43-6efb-48f6-a720-a4692411b24f/sLPRdZxhya.json"
-)
+def render_profiler_panel():
+    run_profile = st.session_state.get("run_profile")
+    if run_profile is None:
+        return
 
-if "stage" not in st.session_state:
-    st.session_state.stage = "upload"
-if "last_upload_time" not in st.session_state:
-    st.session_state.last_upload_time = 0
+    current = finish_run_profile(run_profile)
+    previous = list(reversed(st.session_state.get("profile_history", [])))
 
-inject_styles()
-st.title("ETSY2CSV")
+    with st.expander(f"Profiler: {current['wall'] * 1000:.0f} ms Wall, {current['cpu'] * 1000:.0f} ms CPU"):
+        runs = [current] + previous
+        labels = [f"Dieser Durchlauf ({current['label']})"] + [summary["label"] for summary in previous]
+        selected = st.selectbox("Durchlauf", range(len(runs)), format_func=lambda index: labels[index])
+        render_run_profile(runs[selected])
 
-if st.session_state.stage == "upload":
-    render_howto_lightbox()
-    uploaded_file = st.file_uploader("Etsy-PDF hochladen", type=["pdf"])
+        # Mirrored into a plain key: runs ending in st.rerun() never render
+        # this checkbox, but stop_run_profile still needs its value.
+        st.session_state.profile_dump_enabled = st.checkbox(
+            "Profile auf Festplatte speichern",
+            value=st.session_state.get("profile_dump_enabled", False),
+        )
+        if st.session_state.profile_dump_enabled:
+            st.caption(f"Jeder Durchlauf wird nach {PROFILE_DIR}/ geschrieben.")
 
-    if uploaded_file:
-        is_valid, error_msg = validate_pdf(uploaded_file)
 
-        if is_valid:
-            st.success("Datei verifiziert. Sicherheits-Check bestanden.")
 
-            current_time = time.time()
-            time_since_last = current_time - st.session_state.last_upload_time
 
-            if time_since_last < UPLOAD_DELAY:
-                st.warning(f"API-Schutz: Bitte noch {int(UPLOAD_DELAY - time_since_last)}s warten.")
-            elif centered_button("Jetzt umwandeln"):
-                st.session_state.last_upload_time = current_time
-                st.session_state.uploaded_file = uploaded_file
-                st.session_state.stage = "processing"
-                st.rerun()
-        else:
-            st.error(error_msg)
+start_run_profile()
+try:
+    with track_stage("load_lottie"):
+        lottie_loading = load_lottieurl(
+            "https://lottie.host/c10aad43-6efb-48f6-a720-a4692411b24f/sLPRdZxhya.json"
+        )
 
-if st.session_state.stage == "processing":
-    is_valid, _ = validate_pdf(st.session_state.uploaded_file)
-    if not is_valid:
-        st.error("Upload abgebrochen: Datei nicht zulässig.")
+    if "stage" not in st.session_state:
         st.session_state.stage = "upload"
-        time.sleep(2)
-        st.rerun()
+    if "last_upload_time" not in st.session_state:
+        st.session_state.last_upload_time = 0
+    if "payload_session_id" not in st.session_state:
+        st.session_state.payload_session_id = uuid.uuid4().hex
+
+    metrics = get_metrics_registry()
+    if METRICS_PORT:
+        start_metrics_server(int(METRICS_PORT))
+
+    payload_store = get_payload_store()
+    session_id = st.session_state.payload_session_id
+    payload_store.touch(session_id)
+    payload_store.evict_idle(SESSION_IDLE_TIMEOUT)
+    payload_store.retain(session_id, STAGE_PAYLOADS[st.session_state.stage])
+
+    with track_stage("inject_styles"):
+        inject_styles()
+    st.title("ETSY2CSV")
+
+    if st.session_state.stage == "upload":
+        with track_stage("render_howto_lightbox"):
+            render_howto_lightbox()
+        uploaded_file = st.file_uploader("Etsy-PDF hochladen", type=["pdf"])
+
+        if uploaded_file:
+            with track_stage("validate_upload"):
+                is_valid, error_msg = validate_pdf(uploaded_file)
+            metrics.inc("etsy2jtl_validation_results_total", result="valid" if is_valid else "invalid")
+
+            if is_valid:
+                st.success("Datei verifiziert. Sicherheits-Check bestanden.")
+
+                current_time = time.time()
+                time_since_last = current_time - st.session_state.last_upload_time
+
+                if time_since_last < UPLOAD_DELAY:
+                    st.warning(f"API-Schutz: Bitte noch {int(UPLOAD_DELAY - time_since_last)}s warten.")
+                elif centered_button("Jetzt umwandeln"):
+                    st.session_state.last_upload_time = current_time
+                    st.session_state.uploaded_file_name = uploaded_file.name
+                    st.session_state.uploaded_file_type = uploaded_file.type
+                    payload_store.put(session_id, "pdf", uploaded_file.getvalue())
+                    st.session_state.stage = "processing"
+                    st.rerun()
+            else:
+                st.error(error_msg)
+
+    if st.session_state.stage == "processing":
+        pdf_bytes = payload_store.get(session_id, "pdf")
+        with track_stage("validate_processing"):
+            is_valid, _, page_count = validate_pdf_bytes(pdf_bytes, st.session_state.get("uploaded_file_type", ""))
+        if not is_valid:
+            st.error("Upload abgebrochen: Datei nicht zulässig.")
+            st.session_state.stage = "upload"
+            time.sleep(2)
+            st.rerun()
 
-    if lottie_loading:
-        st_lottie(lottie_loading, height=250, key="loading_anim")
+        if lottie_loading:
+            st_lottie(lottie_loading, height=250, key="loading_anim")
 
-    status_placeholder = st.empty()
-    status_placeholder.info("Verbinde zum Server...")
+        status_placeholder = st.empty()
+        status_placeholder.info("Verbinde zum Server...")
 
-    try:
-        webhook_url = st.secrets["N8N_URL"]
-        auth_token = st.secrets["N8N_TOKEN"]
-        headers = {"x-antsy-token": auth_token}
-
-        files = {
-            "data": (
-                st.session_state.uploaded_file.name,
-                st.session_state.uploaded_file.getvalue(),
-                "application/pdf",
+        try:
+            webhook_url = st.secrets["N8N_URL"]
+            auth_token = st.secrets["N8N_TOKEN"]
+            conversion = convert_pdf(
+                st.session_state.uploaded_file_name,
+                pdf_bytes,
+                page_count,
+                webhook_url,
+                auth_token,
+                payload_store,
+                session_id,
             )
-        }
 
-        response = requests.post(
-            webhook_url,
-            files=files,
-            headers=headers,
-            timeout=90,
-            verify=True,
-        )
+            if conversion["status_code"] == 200:
+                st.session_state.csv_encoding = conversion["encoding"]
+                st.session_state.csv_downloaded = False
+                order_count = conversion["order_count"]
 
-        if response.status_code == 200:
-            st.session_state.csv_text = response.text
-            st.session_state.csv_bytes = response.content
+                if order_count <= 0:
+                    status_placeholder.empty()
+                    st.error("Datei abgelehnt: Keine Etsy-Bestellungen erkannt.")
+                    if centered_button("Zurück"):
+                        st.session_state.stage = "upload"
+                        st.rerun()
+                    st.stop()
 
-            try:
-                df_temp = pd.read_csv(StringIO(response.text), sep=";")
-                order_count = len(df_temp)
-            except (pd.errors.ParserError, ValueError):
-                order_count = 0
+                status_placeholder.success("Sicherheits-Check bestanden!")
+                st.session_state.current_order_count = order_count
 
-            if order_count <= 0:
+                time.sleep(1)
+                status_placeholder.empty()
+                st.session_state.stage = "result"
+                st.rerun()
+            elif conversion["status_code"] == 406:
+                status_placeholder.empty()
+                st.error("Datei wurde vom Sicherheitscheck abgelehnt.")
+                if centered_button("Abbrechen"):
+                    st.session_state.stage = "upload"
+                    st.rerun()
+            elif conversion["status_code"] == 403:
                 status_placeholder.empty()
-                st.error("Datei abgelehnt: Keine Etsy-Bestellungen erkannt.")
+                st.error("Shop ist nicht autorisiert.")
+                if centered_button("Zurück"):
+                    st.session_state.stage = "upload"
+                    st.rerun()
+            else:
+                status_placeholder.empty()
+                st.error(f"Fehler: {conversion['status_code']}. Bitte n8n-Log prüfen.")
                 if centered_button("Zurück"):
                     st.session_state.stage = "upload"
                     st.rerun()
-                st.stop()
-
-            status_placeholder.success("Sicherheits-Check bestanden!")
-            st.session_state.current_order_count = order_count
-            update_global_stats(order_count)
 
-            time.sleep(1)
+        except requests.ConnectionError:
             status_placeholder.empty()
-            st.session_state.stage = "result"
-            st.rerun()
-        elif response.status_code == 406:
+            st.error("Verbindungsfehler: n8n-Server nicht erreichbar.")
+        except requests.Timeout:
             status_placeholder.empty()
-            st.error("Datei wurde vom Sicherheitscheck abgelehnt.")
-            if centered_button("Abbrechen"):
-                st.session_state.stage = "upload"
-                st.rerun()
-        elif response.status_code == 403:
+            st.error("Timeout: n8n hat nicht rechtzeitig geantwortet.")
+        except Exception as e:
+            # Webhook failures are already counted inside convert_pdf.
+            if not isinstance(e, requests.RequestException):
+                metrics.inc("etsy2jtl_pipeline_errors_total", error=type(e).__name__)
             status_placeholder.empty()
-            st.error("Shop ist nicht autorisiert.")
-            if centered_button("Zurück"):
-                st.session_state.stage = "upload"
-                st.rerun()
+            st.error(f"Unerwarteter Fehler: {e}")
+
+    if st.session_state.stage == "result":
+        order_count = st.session_state.get("current_order_count", 0)
+        time_saved_this_file = order_count * TIME_PER_ORDER_MIN
+        with track_stage("load_global_stats"):
+            global_stats = load_global_stats()
+        total_orders = global_stats.get("total_orders", 0)
+        total_time_saved = global_stats.get("total_time_saved", 0)
+
+        st.subheader("Konvertierung abgeschlossen")
+        col1, col2 = st.columns(2)
+        with col1:
+            st.metric("Zeitersparnis dieser Datei", format_duration(time_saved_this_file))
+            st.caption(f"Verarbeitete Einzelbestellungen: {order_count}")
+        with col2:
+            st.metric("Zeitersparnis insgesamt", format_duration(total_time_saved))
+            st.caption(f"Verarbeitete Einzelbestellungen: {total_orders}")
+
+        with track_stage("render_orders_chart"):
+            render_hourly_orders_chart(global_stats)
+
+        csv_bytes = payload_store.get(session_id, "csv")
+        if csv_bytes is None:
+            st.info("Die CSV ist abgelaufen. Bitte die Datei erneut hochladen.")
         else:
-            status_placeholder.empty()
-            st.error(f"Fehler: {response.status_code}. Bitte n8n-Log prüfen.")
-            if centered_button("Zurück"):
-                st.session_state.stage = "upload"
-                st.rerun()
-
-    except requests.ConnectionError:
-        status_placeholder.empty()
-        st.error("Verbindungsfehler: n8n-Server nicht erreichbar.")
-    except requests.Timeout:
-        status_placeholder.empty()
-        st.error("Timeout: n8n hat nicht rechtzeitig geantwortet.")
-    except Exception as e:
-        status_placeholder.empty()
-        st.error(f"Unerwarteter Fehler: {e}")
-
-if st.session_state.stage == "result":
-    order_count = st.session_state.get("current_order_count", 0)
-    time_saved_this_file = order_count * TIME_PER_ORDER_MIN
-    global_stats = load_global_stats()
-    total_orders = global_stats.get("total_orders", 0)
-    total_time_saved = global_stats.get("total_time_saved", 0)
-
-    st.subheader("Konvertierung abgeschlossen")
-    col1, col2 = st.columns(2)
-    with col1:
-        st.metric("Zeitersparnis dieser Datei", format_duration(time_saved_this_file))
-        st.caption(f"Verarbeitete Einzelbestellungen: {order_count}")
-    with col2:
-        st.metric("Zeitersparnis insgesamt", format_duration(total_time_saved))
-        st.caption(f"Verarbeitete Einzelbestellungen: {total_orders}")
-
-    render_hourly_orders_chart(global_stats)
-
-    if "csv_text" in st.session_state:
-        try:
-            df = pd.read_csv(StringIO(st.session_state.csv_text), sep=";")
-            st.dataframe(df, use_container_width=True)
-        except (pd.errors.ParserError, ValueError):
-            st.info("Vorschau nicht verfügbar. CSV bereit zum Download.")
-
-    centered_download_button(
-        "JTL-Ameise Datei speichern",
-        st.session_state.csv_bytes,
-        file_name="antsy_jtl_import.csv",
-    )
-    if centered_button("Neue Datei"):
-        st.session_state.stage = "upload"
-        st.rerun()
-
-    render_post_conversion_howto()
+            try:
+                with track_stage("render_csv_preview"):
+                    csv_text = csv_bytes.decode(st.session_state.get("csv_encoding", "utf-8"), errors="replace")
+                    df = pd.read_csv(StringIO(csv_text), sep=";")
+                    st.dataframe(df, use_container_width=True)
+            except (pd.errors.ParserError, ValueError, LookupError):
+                st.info("Vorschau nicht verfügbar. CSV bereit zum Download.")
+
+            if st.session_state.get("csv_downloaded"):
+                st.caption("CSV heruntergeladen.")
+                if centered_button("Erneut herunterladen"):
+                    st.session_state.csv_downloaded = False
+                    st.rerun()
+            else:
+                payload_store.mark_exported(session_id, "csv", True)
+                centered_download_button(
+                    "JTL-Ameise Datei speichern",
+                    csv_bytes,
+                    file_name="antsy_jtl_import.csv",
+                    on_click=mark_csv_downloaded,
+                    args=(payload_store, session_id),
+                )
+        if centered_button("Neue Datei"):
+            st.session_state.stage = "upload"
+            st.rerun()
 
-st.divider()
-st.caption("Es handelt sich hier um eine Beta Version. Bitte prüfe die generierte CSV vor dem Import in JTL-Ameise auf Korrektheit. Bei Problemen wende dich an den Support.")
-st.caption("Hier wird keine KI verwendet.")
+        with track_stage("render_post_conversion_howto"):
+            render_post_conversion_howto()
+
+    st.divider()
+    st.caption("Es handelt sich hier um eine Beta Version. Bitte prüfe die generierte CSV vor dem Import in JTL-Ameise auf Korrektheit. Bei Problemen wende dich an den Support.")
+    st.caption("Hier wird keine KI verwendet.")
+    render_memory_usage(payload_store, session_id)
+    render_profiler_panel()
+finally:
+    stop_run_profile()
+    # Every run records stage timings, so the file export is refreshed at the
+    # end of each run, not only after conversions.
+    write_metrics_file()
@@ -0,0 +1,345 @@
+"""Concurrent-session load test for app.py.
+
+Drives N simulated operators through upload -> processing -> result against
+a local stub of the n8n webhook:
+
+    python loadtest.py --sessions 8 --iterations 3 --latency-ms 800 --error-rate 0.1
+
+Streamlit serves every session as a thread of one process, and AppTest is
+not safe to run concurrently. So the harness imports pipeline.py, the module
+app.py builds its stages from, and calls the same functions from one thread
+per session. The UI pauses (time.sleep) of the processing stage are not
+included in the latencies.
+
+The run happens in a scratch working directory so the real stats file,
+warehouse and metrics are not touched.
+"""
+
+import argparse
+import json
+import os
+import random
+import resource
+import shutil
+import statistics
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import StringIO
+from typing import Optional
+from uuid import uuid4
+
+import pandas as pd
+import requests
+
+import pipeline
+
+SAMPLE_PDF_LINES = (
+    "Etsy Bestellung Nr. 1234567890",
+    "Versand an Max Mustermann",
+    "Origami Konfetti Mix",
+    "Gesamtsumme der Bestellung 12.90 EUR",
+    "Bezahlt mit Etsy Payments",
+)
+
+
+def build_sample_pdf(lines: tuple[str, ...] = SAMPLE_PDF_LINES) -> bytes:
+    text_ops = "\n".join(f"({line}) Tj T*" for line in lines)
+    content = f"BT /F1 12 Tf 14 TL 72 720 Td\n{text_ops}\nET".encode("latin-1")
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+        b"/Resources << /Font << /F1 4 0 R >> >> /Contents 5 0 R >>",
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+        b"<< /Length " + str(len(content)).encode() + b" >>\nstream\n" + content + b"\nendstream",
+    ]
+
+    pdf = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(pdf))
+        pdf += f"{number} 0 obj\n".encode() + body + b"\nendobj\n"
+
+    xref_offset = len(pdf)
+    pdf += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    for offset in offsets:
+        pdf += f"{offset:010d} 00000 n \n".encode()
+    pdf += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref_offset}\n%%EOF\n".encode()
+    return bytes(pdf)
+
+
+def build_sample_csv(order_count: int) -> bytes:
+    countries = ("DE", "AT", "CH", "FR", "NL")
+    rows = ["Auftragsnummer;E-Mail;Land;Gesamtsumme"]
+    for _ in range(order_count):
+        order_id = random.randint(10**9, 10**10 - 1)
+        buyer = f"kunde{random.randint(1, 50)}@example.com"
+        rows.append(f"{order_id};{buyer};{random.choice(countries)};{random.uniform(5, 80):.2f}")
+    return ("\n".join(rows) + "\n").encode("utf-8")
+
+
+class StubWebhook:
+    def __init__(self, latency_ms: float, jitter_ms: float, error_rate: float, error_status: int, orders: int):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.orders = orders
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._server: Optional[ThreadingHTTPServer] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address
+        return f"http://{host}:{port}/webhook"
+
+    def start(self):
+        stub = self
+
+        class WebhookHandler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                with stub._lock:
+                    stub.requests += 1
+
+                delay_ms = max(random.gauss(stub.latency_ms, stub.jitter_ms), 0)
+                time.sleep(delay_ms / 1000)
+
+                if random.random() < stub.error_rate:
+                    status, body = stub.error_status, b"stub error"
+                else:
+                    status, body = 200, build_sample_csv(stub.orders)
+                self.send_response(status)
+                self.send_header("Content-Type", "text/csv; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), WebhookHandler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+
+
+def run_session(
+    session_index: int,
+    iterations: int,
+    pdf_name: str,
+    pdf_bytes: bytes,
+    webhook_url: str,
+) -> list[dict]:
+    payload_store = pipeline.get_payload_store()
+    stage_payloads = pipeline.STAGE_PAYLOADS
+    session_id = uuid4().hex
+
+    def enter_stage(stage: str):
+        # Mirrors the bookkeeping at the top of every script run.
+        payload_store.touch(session_id)
+        payload_store.evict_idle(pipeline.SESSION_IDLE_TIMEOUT)
+        payload_store.retain(session_id, stage_payloads[stage])
+
+    results = []
+    for _ in range(iterations):
+        result = {"session": session_index, "orders": 0}
+        started = time.perf_counter()
+        try:
+            enter_stage("upload")
+            with pipeline.track_stage("validate_upload"):
+                is_valid, _, _ = pipeline.validate_pdf_bytes(pdf_bytes, "application/pdf")
+            if not is_valid:
+                result.update(outcome="invalid_upload", seconds=time.perf_counter() - started)
+                results.append(result)
+                continue
+            payload_store.put(session_id, "pdf", pdf_bytes)
+
+            enter_stage("processing")
+            stored_pdf = payload_store.get(session_id, "pdf")
+            with pipeline.track_stage("validate_processing"):
+                is_valid, _, page_count = pipeline.validate_pdf_bytes(stored_pdf, "application/pdf")
+            if not is_valid:
+                result.update(outcome="invalid_processing", seconds=time.perf_counter() - started)
+                results.append(result)
+                continue
+
+            conversion = pipeline.convert_pdf(
+                pdf_name, stored_pdf, page_count, webhook_url, "loadtest", payload_store, session_id
+            )
+            elapsed = time.perf_counter() - started
+            if conversion["status_code"] != 200:
+                outcome = f"http_{conversion['status_code']}"
+            elif conversion["order_count"] <= 0:
+                outcome = "no_orders"
+            else:
+                outcome = "ok"
+            result.update(outcome=outcome, seconds=elapsed, orders=conversion["order_count"])
+
+            if outcome == "ok":
+                enter_stage("result")
+                stats = pipeline.load_global_stats()
+                pipeline.build_orders_chart_spec(
+                    next(iter(pipeline.CHART_WINDOWS)),
+                    pipeline.berlin_now_hour_naive().strftime("%Y-%m-%d %H:00"),
+                    int(stats.get("stats_version", 0)),
+                    stats,
+                )
+                csv_bytes = payload_store.get(session_id, "csv")
+                pd.read_csv(StringIO(csv_bytes.decode(conversion["encoding"], errors="replace")), sep=";")
+                payload_store.spill(session_id, "csv")
+        except requests.ConnectionError:
+            result.update(outcome="connection_error", seconds=time.perf_counter() - started)
+        except requests.Timeout:
+            result.update(outcome="timeout", seconds=time.perf_counter() - started)
+        except Exception as e:
+            result.update(outcome=f"exception: {e!r}", seconds=time.perf_counter() - started)
+        results.append(result)
+
+    # "Neue Datei": back to upload, which releases the session's payloads.
+    enter_stage("upload")
+    return results
+
+
+def percentile(values: list[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(int(round(pct / 100 * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+
+def summarize(
+    results: list[dict],
+    wall_seconds: float,
+    stats: dict,
+    rss_start: Optional[int],
+    rss_end: Optional[int],
+    payload_usage: dict,
+) -> dict:
+    ok = [r for r in results if r["outcome"] == "ok"]
+    latencies = [r["seconds"] for r in ok]
+    outcomes: dict[str, int] = {}
+    for result in results:
+        outcomes[result["outcome"]] = outcomes.get(result["outcome"], 0) + 1
+
+    expected_orders = sum(r["orders"] for r in ok)
+    expected_conversions = len(ok)
+    return {
+        "conversions": len(results),
+        "successful": len(ok),
+        "wall_seconds": round(wall_seconds, 3),
+        "throughput_per_min": round(len(ok) / wall_seconds * 60, 2) if wall_seconds else 0.0,
+        "latency_seconds": {
+            "p50": round(percentile(latencies, 50), 3),
+            "p95": round(percentile(latencies, 95), 3),
+            "p99": round(percentile(latencies, 99), 3),
+            "mean": round(statistics.fmean(latencies), 3) if latencies else 0.0,
+            "max": round(max(latencies), 3) if latencies else 0.0,
+        },
+        "outcomes": outcomes,
+        "lost_stats_updates": {
+            "conversions": expected_conversions - int(stats.get("total_conversions", 0)),
+            "orders": expected_orders - int(stats.get("total_orders", 0)),
+        },
+        "memory": {
+            "rss_start_bytes": rss_start,
+            "rss_end_bytes": rss_end,
+            "rss_growth_bytes": (rss_end - rss_start) if rss_start and rss_end else None,
+            "max_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+            "payload_memory_bytes": payload_usage.get("global_memory_bytes"),
+            "payload_spilled_bytes": payload_usage.get("global_spilled_bytes"),
+        },
+    }
+
+
+def print_report(summary: dict, webhook_requests: int):
+    latency = summary["latency_seconds"]
+    memory = summary["memory"]
+    lost = summary["lost_stats_updates"]
+    print(f"Conversions:      {summary['successful']}/{summary['conversions']} ok in {summary['wall_seconds']}s")
+    print(f"Throughput:       {summary['throughput_per_min']} conversions/min")
+    print(
+        f"Latency (s):      p50={latency['p50']} p95={latency['p95']} p99={latency['p99']} "
+        f"mean={latency['mean']} max={latency['max']}"
+    )
+    print(f"Webhook requests: {webhook_requests}")
+    print(f"Lost stats:       {lost['conversions']} conversions, {lost['orders']} orders")
+    if memory["rss_growth_bytes"] is not None:
+        print(
+            f"RSS:              {memory['rss_start_bytes'] / 2**20:.1f} MB -> "
+            f"{memory['rss_end_bytes'] / 2**20:.1f} MB (peak {memory['max_rss_bytes'] / 2**20:.1f} MB)"
+        )
+    print(
+        f"Payloads left:    {memory['payload_memory_bytes']} B in memory, "
+        f"{memory['payload_spilled_bytes']} B spilled"
+    )
+    print("Outcomes:")
+    for outcome, count in sorted(summary["outcomes"].items(), key=lambda item: -item[1]):
+        print(f"  {count:5d}  {outcome}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test app.py with concurrent simulated sessions.")
+    parser.add_argument("--sessions", type=int, default=4, help="concurrent simulated operators")
+    parser.add_argument("--iterations", type=int, default=3, help="conversions per session")
+    parser.add_argument("--latency-ms", type=float, default=500, help="mean stub webhook latency")
+    parser.add_argument("--jitter-ms", type=float, default=100, help="stub webhook latency std deviation")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of webhook calls that fail")
+    parser.add_argument("--error-status", type=int, default=500, help="HTTP status for failed webhook calls")
+    parser.add_argument("--orders", type=int, default=20, help="orders per stub CSV")
+    parser.add_argument("--pdf", help="upload this PDF instead of the generated sample")
+    parser.add_argument("--json", action="store_true", help="print the summary as JSON")
+    args = parser.parse_args()
+
+    if args.pdf:
+        with open(args.pdf, "rb") as f:
+            pdf_bytes = f.read()
+        pdf_name = os.path.basename(args.pdf)
+    else:
+        pdf_bytes = build_sample_pdf()
+        pdf_name = "etsy_loadtest.pdf"
+
+    stub = StubWebhook(args.latency_ms, args.jitter_ms, args.error_rate, args.error_status, args.orders)
+    stub.start()
+
+    workdir = tempfile.mkdtemp(prefix="etsy2jtl-loadtest-")
+    previous_cwd = os.getcwd()
+    os.chdir(workdir)
+
+    try:
+        rss_start = pipeline.process_rss_bytes()
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.sessions) as pool:
+            futures = [
+                pool.submit(run_session, index, args.iterations, pdf_name, pdf_bytes, stub.url)
+                for index in range(args.sessions)
+            ]
+            results = [result for future in futures for result in future.result()]
+        wall_seconds = time.perf_counter() - started
+        rss_end = pipeline.process_rss_bytes()
+        payload_usage = pipeline.get_payload_store().usage()
+
+        stats = pipeline.load_global_stats()
+    finally:
+        os.chdir(previous_cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+        stub.stop()
+
+    summary = summarize(results, wall_seconds, stats, rss_start, rss_end, payload_usage)
+    if args.json:
+        print(json.dumps(summary, indent=2))
+    else:
+        print_report(summary, stub.requests)
+
+
+if __name__ == "__main__":
+    main()
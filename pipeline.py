@@ -0,0 +1,872 @@
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+import atexit
+import glob
+import shutil
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO, StringIO
+from typing import Optional
+from zoneinfo import ZoneInfo
+
+import altair as alt
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import requests
+import streamlit as st
+from pypdf import PdfReader
+
+STATS_FILE = "antsy_global_stats.json"
+TIME_PER_ORDER_MIN = 2.5
+PDF_MAGIC_BYTES = b"%PDF"
+HISTORY_HOURS = 12
+HISTORY_DAYS = 30
+CHART_WINDOWS = {
+    "12 Std.": ("hourly", HISTORY_HOURS),
+    "7 Tage": ("daily", 7),
+    "30 Tage": ("daily", HISTORY_DAYS),
+}
+BERLIN_TZ = ZoneInfo("Europe/Berlin")
+PAYLOAD_SPILL_THRESHOLD_BYTES = 2 * 1024 * 1024
+PAYLOAD_MEMORY_BUDGET_BYTES = 64 * 1024 * 1024
+SESSION_IDLE_TIMEOUT = 30 * 60
+PAYLOAD_SPILL_PREFIX = "etsy2jtl-payloads-"
+STAGE_PAYLOADS = {"upload": (), "processing": ("pdf",), "result": ("csv",)}
+METRICS_FILE = "antsy_metrics.prom"
+METRICS_PORT = os.environ.get("ETSY2JTL_METRICS_PORT")
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 90)
+METRIC_DEFINITIONS = {
+    "etsy2jtl_stage_duration_seconds": ("histogram", "Wall time per pipeline stage.", LATENCY_BUCKETS),
+    "etsy2jtl_stage_cpu_seconds": ("histogram", "CPU time per pipeline stage.", LATENCY_BUCKETS),
+    "etsy2jtl_webhook_responses_total": ("counter", "n8n webhook outcomes by status or error.", None),
+    "etsy2jtl_validation_results_total": ("counter", "PDF validation results.", None),
+    "etsy2jtl_pipeline_errors_total": ("counter", "Unexpected processing errors outside the webhook call.", None),
+    "etsy2jtl_conversion_pages": ("histogram", "PDF pages per conversion.", (1, 2, 5, 10, 20, 50, 100, 200)),
+    "etsy2jtl_conversion_pdf_bytes": (
+        "histogram",
+        "PDF size per conversion.",
+        (64e3, 256e3, 1e6, 4e6, 16e6, 64e6),
+    ),
+    "etsy2jtl_conversion_orders": ("histogram", "Orders per conversion.", (1, 5, 10, 25, 50, 100, 250, 500)),
+}
+WAREHOUSE_DIR = "antsy_order_warehouse"
+WAREHOUSE_ORDER_ID_COLUMNS = ("Auftragsnummer", "Externe Auftragsnummer", "Bestellnummer", "Order ID")
+WAREHOUSE_BUYER_COLUMNS = ("E-Mail", "Email", "Kundennummer", "Name", "Buyer")
+WAREHOUSE_COUNTRY_COLUMNS = ("Land", "Lieferland", "Land (Lieferadresse)", "Country", "Ship Country")
+WAREHOUSE_REVENUE_COLUMNS = ("Gesamtsumme", "Auftragswert", "Bruttopreis", "Order Total", "Total")
+WAREHOUSE_ORDERS_SCHEMA = pa.schema(
+    [
+        ("conversion_id", pa.string()),
+        ("converted_at", pa.timestamp("s")),
+        ("order_id", pa.string()),
+        ("buyer", pa.string()),
+        ("country", pa.string()),
+        ("revenue", pa.float64()),
+        ("raw", pa.string()),
+    ]
+)
+WAREHOUSE_CONVERSIONS_SCHEMA = pa.schema(
+    [
+        ("conversion_id", pa.string()),
+        ("converted_at", pa.timestamp("s")),
+        ("file_name", pa.string()),
+        ("pdf_bytes", pa.int64()),
+        ("csv_bytes", pa.int64()),
+        ("order_count", pa.int64()),
+    ]
+)
+WAREHOUSE_PARTITIONING = ds.partitioning(pa.schema([("day", pa.string())]), flavor="hive")
+
+
+def berlin_now_naive() -> datetime:
+    # Keep timestamps in Berlin local time while storing naive hour keys.
+    return datetime.now(BERLIN_TZ).replace(tzinfo=None)
+
+
+def berlin_now_hour_naive() -> datetime:
+    return berlin_now_naive().replace(minute=0, second=0, microsecond=0)
+
+
+def validate_pdf_bytes(file_bytes: Optional[bytes], mime_type: str) -> tuple[bool, str, int]:
+    # Also returns the page count so callers can record it without reparsing.
+    generic_invalid_msg = "Datei abgelehnt. Nur gültige Etsy-Bestellbestätigungen sind erlaubt."
+
+    if mime_type != "application/pdf" or not file_bytes:
+        return False, generic_invalid_msg, 0
+
+    try:
+        if not file_bytes.startswith(PDF_MAGIC_BYTES):
+            return False, generic_invalid_msg, 0
+
+        reader = PdfReader(BytesIO(file_bytes))
+        page_count = len(reader.pages)
+        if page_count == 0:
+            return False, generic_invalid_msg, 0
+
+        scan_text = "\n".join((page.extract_text() or "") for page in reader.pages)
+        text_lower = scan_text.lower()
+
+        order_marker_ok = bool(
+            re.search(r"bestellung\s+nr\.\s*\d+", text_lower)
+            or re.search(r"order\s*#\s*\d+", text_lower)
+        )
+        etsy_brand_ok = "etsy" in text_lower
+        payment_ok = "etsy payments" in text_lower or "paypal" in text_lower
+        shipping_ok = "versand an" in text_lower or "ship to" in text_lower
+        total_ok = "gesamtsumme der bestellung" in text_lower or "order total" in text_lower
+        origami_ok = "origami" in text_lower and "konfetti" in text_lower
+
+        if order_marker_ok and etsy_brand_ok and payment_ok and shipping_ok and total_ok and origami_ok:
+            return True, "", page_count
+        return False, generic_invalid_msg, page_count
+    except Exception:
+        return False, generic_invalid_msg, 0
+
+
+def trim_hourly_history(history: dict, now_hour: Optional[datetime] = None) -> dict:
+    if not isinstance(history, dict):
+        return {}
+
+    reference_hour = now_hour or berlin_now_hour_naive()
+    trimmed: dict[str, int] = {}
+
+    for hour_key, value in history.items():
+        try:
+            hour_dt = datetime.strptime(hour_key, "%Y-%m-%d %H:00")
+            count = max(int(value), 0)
+        except (TypeError, ValueError):
+            continue
+
+        hours_ago = (reference_hour - hour_dt).total_seconds() / 3600
+        if 0 <= hours_ago < HISTORY_HOURS:
+            trimmed[hour_key] = count
+
+    return trimmed
+
+
+def trim_daily_history(history: dict, now_hour: Optional[datetime] = None) -> dict:
+    if not isinstance(history, dict):
+        return {}
+
+    today = (now_hour or berlin_now_hour_naive()).replace(hour=0)
+    trimmed: dict[str, int] = {}
+
+    for day_key, value in history.items():
+        try:
+            day_dt = datetime.strptime(day_key, "%Y-%m-%d")
+            count = max(int(value), 0)
+        except (TypeError, ValueError):
+            continue
+
+        days_ago = (today - day_dt).days
+        if 0 <= days_ago < HISTORY_DAYS:
+            trimmed[day_key] = count
+
+    return trimmed
+
+
+def build_hourly_history_df(stats: dict) -> pd.DataFrame:
+    now_hour = berlin_now_hour_naive()
+    history = trim_hourly_history(stats.get("hourly_orders", {}), now_hour)
+
+    rows = []
+    for offset in range(HISTORY_HOURS - 1, -1, -1):
+        hour_dt = now_hour - timedelta(hours=offset)
+        hour_key = hour_dt.strftime("%Y-%m-%d %H:00")
+        rows.append(
+            {
+                "Stunde": hour_dt.strftime("%H:%M"),
+                "Bestellungen": int(history.get(hour_key, 0)),
+            }
+        )
+    return pd.DataFrame(rows)
+
+
+def build_daily_history_df(stats: dict, days: int) -> pd.DataFrame:
+    now_hour = berlin_now_hour_naive()
+    history = trim_daily_history(stats.get("daily_orders", {}), now_hour)
+
+    rows = []
+    for offset in range(days - 1, -1, -1):
+        day_dt = now_hour.replace(hour=0) - timedelta(days=offset)
+        rows.append(
+            {
+                "Tag": day_dt.strftime("%d.%m."),
+                "Bestellungen": int(history.get(day_dt.strftime("%Y-%m-%d"), 0)),
+            }
+        )
+    return pd.DataFrame(rows)
+
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def build_orders_chart_spec(window: str, hour_key: str, stats_version: int, _stats: dict) -> dict:
+    # Cached per (window, Berlin hour, stats version): the data only changes
+    # when an order lands or the hour rolls over, so reruns reuse the spec.
+    granularity, span = CHART_WINDOWS[window]
+    if granularity == "hourly":
+        history_df = build_hourly_history_df(_stats)
+    else:
+        history_df = build_daily_history_df(_stats, span)
+    label = "Stunde" if granularity == "hourly" else "Tag"
+    bar_size = 24 if span <= HISTORY_HOURS else 12
+
+    chart = (
+        alt.Chart(history_df)
+        .mark_bar(size=bar_size, cornerRadiusTopLeft=6, cornerRadiusTopRight=6)
+        .encode(
+            x=alt.X(f"{label}:N", sort=None, axis=alt.Axis(title=None, labelAngle=0)),
+            y=alt.Y("Bestellungen:Q", axis=alt.Axis(title="Bestellungen"), scale=alt.Scale(domainMin=0)),
+            color=alt.value("#2FD38A"),
+            tooltip=[
+                alt.Tooltip(f"{label}:N", title=label),
+                alt.Tooltip("Bestellungen:Q", title="Bestellungen"),
+            ],
+        )
+        .properties(height=230)
+        .configure_view(strokeWidth=0)
+        .configure_axis(
+            labelColor="#eafff2",
+            titleColor="#eafff2",
+            gridColor="rgba(234, 255, 242, 0.16)",
+            domainColor="rgba(234, 255, 242, 0.22)",
+            tickColor="rgba(234, 255, 242, 0.22)",
+        )
+    )
+    return chart.to_dict()
+
+
+@st.cache_resource
+def get_stats_lock() -> threading.Lock:
+    return threading.Lock()
+
+
+def update_global_stats(order_count: int):
+    # Read-modify-write of the shared stats file; concurrent sessions would
+    # otherwise lose updates and reuse the same stats_version.
+    with get_stats_lock():
+        stats = load_global_stats()
+        stats["total_orders"] = stats.get("total_orders", 0) + order_count
+        stats["total_time_saved"] = stats.get("total_time_saved", 0) + (order_count * TIME_PER_ORDER_MIN)
+        stats["total_conversions"] = stats.get("total_conversions", 0) + 1
+
+        current_hour = berlin_now_hour_naive()
+        current_hour_key = current_hour.strftime("%Y-%m-%d %H:00")
+        hourly_history = trim_hourly_history(stats.get("hourly_orders", {}), current_hour)
+        hourly_history[current_hour_key] = hourly_history.get(current_hour_key, 0) + order_count
+        stats["hourly_orders"] = trim_hourly_history(hourly_history, current_hour)
+
+        current_day_key = current_hour.strftime("%Y-%m-%d")
+        daily_history = trim_daily_history(stats.get("daily_orders", {}), current_hour)
+        daily_history[current_day_key] = daily_history.get(current_day_key, 0) + order_count
+        stats["daily_orders"] = daily_history
+        stats["stats_version"] = int(stats.get("stats_version", 0)) + 1
+
+        # Replace atomically so readers never cache a half-written file.
+        tmp_path = f"{STATS_FILE}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(stats, f, indent=2)
+            os.replace(tmp_path, STATS_FILE)
+        except IOError:
+            pass
+
+
+def load_global_stats() -> dict:
+    if os.path.exists(STATS_FILE):
+        try:
+            with open(STATS_FILE, "r", encoding="utf-8") as f:
+                stats = json.load(f)
+                stats["hourly_orders"] = trim_hourly_history(stats.get("hourly_orders", {}))
+                stats["daily_orders"] = trim_daily_history(stats.get("daily_orders", {}))
+                return stats
+        except (json.JSONDecodeError, IOError):
+            return {}
+    return {
+        "total_orders": 0,
+        "total_time_saved": 0,
+        "total_conversions": 0,
+        "hourly_orders": {},
+        "daily_orders": {},
+        "stats_version": 0,
+    }
+
+
+def _find_column(df: pd.DataFrame, candidates: tuple[str, ...]) -> Optional[str]:
+    columns_by_lower = {str(column).strip().lower(): column for column in df.columns}
+    for candidate in candidates:
+        column = columns_by_lower.get(candidate.lower())
+        if column is not None:
+            return column
+    return None
+
+
+def _parse_amount(value) -> Optional[float]:
+    # JTL import uses "." as decimal and "," as thousands separator.
+    if value is None or (isinstance(value, float) and pd.isna(value)):
+        return None
+    cleaned = re.sub(r"[^0-9.\-]", "", str(value).replace(",", ""))
+    try:
+        return float(cleaned)
+    except ValueError:
+        return None
+
+
+def _write_parquet_atomic(table: pa.Table, path: str):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Dot-prefixed temp files are skipped by dataset discovery.
+    tmp_path = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.{uuid.uuid4().hex}.tmp")
+    pq.write_table(table, tmp_path)
+    os.replace(tmp_path, path)
+
+
+@st.cache_resource
+def get_warehouse_lock() -> threading.Lock:
+    # Sessions are threads of one process; appends and compaction serialize here.
+    return threading.Lock()
+
+
+def compact_warehouse_partitions(table_name: str, today: str):
+    # One file per conversion keeps appends cheap; finished days are merged
+    # into a single file so queries over years only touch one file per day.
+    # A marker records the last compacted day so older partitions are never
+    # revisited.
+    table_dir = os.path.join(WAREHOUSE_DIR, table_name)
+    marker_path = os.path.join(table_dir, ".compacted_through")
+    try:
+        with open(marker_path, "r", encoding="utf-8") as f:
+            compacted_through = f.read().strip()
+    except IOError:
+        compacted_through = ""
+
+    pending_days = sorted(
+        partition[len("day="):]
+        for partition in os.listdir(table_dir)
+        if partition.startswith("day=") and compacted_through < partition[len("day="):] < today
+    )
+    for day in pending_days:
+        partition_dir = os.path.join(table_dir, f"day={day}")
+        parts = sorted(name for name in os.listdir(partition_dir) if name.endswith(".parquet"))
+        if "compacted.parquet" in parts:
+            # An interrupted compaction already merged these parts; merging
+            # them again would duplicate rows, so only the leftovers go.
+            for name in parts:
+                if name != "compacted.parquet":
+                    os.remove(os.path.join(partition_dir, name))
+        elif len(parts) > 1:
+            part_paths = [os.path.join(partition_dir, name) for name in parts]
+            merged = pa.concat_tables(pq.read_table(path) for path in part_paths)
+            _write_parquet_atomic(merged, os.path.join(partition_dir, "compacted.parquet"))
+            for path in part_paths:
+                if not path.endswith("compacted.parquet"):
+                    os.remove(path)
+
+        with open(marker_path, "w", encoding="utf-8") as f:
+            f.write(day)
+
+
+def append_conversion_to_warehouse(orders_df: pd.DataFrame, file_name: str, pdf_bytes: int, csv_bytes: int):
+    converted_at = berlin_now_naive().replace(microsecond=0)
+    day = converted_at.strftime("%Y-%m-%d")
+    conversion_id = uuid.uuid4().hex
+
+    order_id_col = _find_column(orders_df, WAREHOUSE_ORDER_ID_COLUMNS)
+    buyer_col = _find_column(orders_df, WAREHOUSE_BUYER_COLUMNS)
+    country_col = _find_column(orders_df, WAREHOUSE_COUNTRY_COLUMNS)
+    revenue_col = _find_column(orders_df, WAREHOUSE_REVENUE_COLUMNS)
+
+    def column_values(column: Optional[str]) -> list:
+        if column is None:
+            return [None] * len(orders_df)
+        return [None if pd.isna(value) else str(value).strip() for value in orders_df[column]]
+
+    orders = pd.DataFrame(
+        {
+            "conversion_id": conversion_id,
+            "converted_at": converted_at,
+            "order_id": column_values(order_id_col),
+            "buyer": column_values(buyer_col),
+            "country": column_values(country_col),
+            "revenue": [_parse_amount(value) for value in column_values(revenue_col)],
+            "raw": orders_df.astype(str).to_json(orient="records", lines=True, force_ascii=False).splitlines(),
+        }
+    )
+    conversion = pd.DataFrame(
+        [
+            {
+                "conversion_id": conversion_id,
+                "converted_at": converted_at,
+                "file_name": file_name,
+                "pdf_bytes": pdf_bytes,
+                "csv_bytes": csv_bytes,
+                "order_count": len(orders_df),
+            }
+        ]
+    )
+
+    tables = (
+        ("orders", orders, WAREHOUSE_ORDERS_SCHEMA),
+        ("conversions", conversion, WAREHOUSE_CONVERSIONS_SCHEMA),
+    )
+    with get_warehouse_lock():
+        try:
+            for table_name, frame, schema in tables:
+                table = pa.Table.from_pandas(frame, schema=schema, preserve_index=False)
+                path = os.path.join(WAREHOUSE_DIR, table_name, f"day={day}", f"{conversion_id}.parquet")
+                _write_parquet_atomic(table, path)
+        except (OSError, pa.ArrowException):
+            return
+
+        for table_name, _, _ in tables:
+            try:
+                compact_warehouse_partitions(table_name, day)
+            except (OSError, pa.ArrowException):
+                pass
+
+
+def load_warehouse_table(table_name: str, columns: list[str], since: Optional[datetime] = None) -> pd.DataFrame:
+    table_dir = os.path.join(WAREHOUSE_DIR, table_name)
+    if not os.path.isdir(table_dir):
+        return pd.DataFrame(columns=columns)
+
+    schema = WAREHOUSE_ORDERS_SCHEMA if table_name == "orders" else WAREHOUSE_CONVERSIONS_SCHEMA
+    dataset = ds.dataset(
+        table_dir,
+        format="parquet",
+        schema=pa.unify_schemas([schema, WAREHOUSE_PARTITIONING.schema]),
+        partitioning=WAREHOUSE_PARTITIONING,
+    )
+    day_filter = ds.field("day") >= since.strftime("%Y-%m-%d") if since else None
+    try:
+        return dataset.to_table(columns=columns, filter=day_filter).to_pandas()
+    except (OSError, pa.ArrowException):
+        return pd.DataFrame(columns=columns)
+
+
+def load_warehouse_orders(columns: list[str], since: Optional[datetime] = None) -> pd.DataFrame:
+    # Converting the same PDF again stores its orders again; only the latest
+    # copy of each order_id counts. Rows without an order_id are kept as is.
+    load_columns = list(dict.fromkeys(columns + ["order_id", "converted_at"]))
+    orders = load_warehouse_table("orders", load_columns, since)
+    if orders.empty:
+        return orders[columns]
+
+    orders = orders.sort_values("converted_at", kind="stable")
+    has_order_id = orders["order_id"].notna()
+    latest = orders[has_order_id].drop_duplicates(subset="order_id", keep="last")
+    orders = pd.concat([latest, orders[~has_order_id]]).sort_index()
+    return orders[columns].reset_index(drop=True)
+
+
+def query_orders_per_period(freq: str = "D", since: Optional[datetime] = None) -> pd.DataFrame:
+    orders = load_warehouse_orders(["converted_at"], since)
+    if orders.empty:
+        return pd.DataFrame(columns=["Zeitraum", "Bestellungen"])
+
+    period = pd.to_datetime(orders["converted_at"]).dt.to_period(freq).astype(str)
+    per_period = orders.groupby(period).size()
+    return pd.DataFrame({"Zeitraum": per_period.index, "Bestellungen": per_period.values.astype(int)})
+
+
+def query_revenue_by_country(since: Optional[datetime] = None) -> pd.DataFrame:
+    orders = load_warehouse_orders(["country", "revenue"], since)
+    if orders.empty:
+        return pd.DataFrame(columns=["Land", "Umsatz", "Bestellungen"])
+
+    orders["country"] = orders["country"].fillna("Unbekannt")
+    per_country = orders.groupby("country").agg(Umsatz=("revenue", "sum"), Bestellungen=("revenue", "size"))
+    per_country = per_country.sort_values("Umsatz", ascending=False).reset_index()
+    return per_country.rename(columns={"country": "Land"})
+
+
+def query_repeat_buyers(min_orders: int = 2, since: Optional[datetime] = None) -> pd.DataFrame:
+    orders = load_warehouse_orders(["buyer", "order_id", "revenue", "converted_at"], since)
+    orders = orders.dropna(subset=["buyer"])
+    if orders.empty:
+        return pd.DataFrame(columns=["Kunde", "Bestellungen", "Umsatz", "Letzte Bestellung"])
+
+    orders["order_id"] = orders["order_id"].fillna(orders.index.to_series().astype(str))
+    per_buyer = orders.groupby("buyer").agg(
+        Bestellungen=("order_id", "nunique"),
+        Umsatz=("revenue", "sum"),
+        **{"Letzte Bestellung": ("converted_at", "max")},
+    )
+    repeat = per_buyer[per_buyer["Bestellungen"] >= min_orders]
+    repeat = repeat.sort_values("Bestellungen", ascending=False).reset_index()
+    return repeat.rename(columns={"buyer": "Kunde"})
+
+
+def format_bytes(num_bytes: Optional[int]) -> str:
+    if num_bytes is None:
+        return "n/a"
+    size = float(num_bytes)
+    for unit in ("B", "KB", "MB"):
+        if size < 1024:
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GB"
+
+
+def process_rss_bytes() -> Optional[int]:
+    try:
+        with open("/proc/self/statm", "r", encoding="utf-8") as f:
+            resident_pages = int(f.read().split()[1])
+        return resident_pages * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _process_alive(pid: int) -> bool:
+    # Our own PID can only show up on a directory left by an earlier process
+    # (PIDs repeat across container restarts), so it counts as dead.
+    if pid == os.getpid():
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def remove_stale_spill_dirs():
+    pattern = os.path.join(tempfile.gettempdir(), f"{PAYLOAD_SPILL_PREFIX}*")
+    for spill_dir in glob.glob(pattern):
+        owner = os.path.basename(spill_dir)[len(PAYLOAD_SPILL_PREFIX):].split("-", 1)[0]
+        if owner.isdigit() and _process_alive(int(owner)):
+            continue
+        shutil.rmtree(spill_dir, ignore_errors=True)
+
+
+class SessionPayloadStore:
+    # Shared across all sessions of this process. Payloads above the spill
+    # threshold, or beyond the global memory budget, live in temp files.
+
+    def __init__(self, spill_threshold: int, memory_budget: int):
+        self.spill_threshold = spill_threshold
+        self.memory_budget = memory_budget
+        self._lock = threading.Lock()
+        self._payloads: dict[str, dict[str, dict]] = {}
+        self._last_seen: dict[str, float] = {}
+        # Spilled PDFs and CSVs contain customer data: remove directories
+        # left behind by dead processes and this process' own one on exit.
+        remove_stale_spill_dirs()
+        self._spill_dir = tempfile.mkdtemp(prefix=f"{PAYLOAD_SPILL_PREFIX}{os.getpid()}-")
+        atexit.register(shutil.rmtree, self._spill_dir, ignore_errors=True)
+
+    def touch(self, session_id: str):
+        with self._lock:
+            self._last_seen[session_id] = time.time()
+
+    def put(self, session_id: str, name: str, data: bytes):
+        with self._lock:
+            self._drop(session_id, name)
+            entry = {"data": data, "path": None, "size": len(data), "exported": False}
+            self._payloads.setdefault(session_id, {})[name] = entry
+            self._last_seen[session_id] = time.time()
+            if entry["size"] > self.spill_threshold:
+                self._spill(session_id, name, entry)
+            self._enforce_budget()
+
+    def get(self, session_id: str, name: str) -> Optional[bytes]:
+        with self._lock:
+            entry = self._payloads.get(session_id, {}).get(name)
+            if entry is None:
+                return None
+            if entry["data"] is not None:
+                return entry["data"]
+            path = entry["path"]
+        try:
+            with open(path, "rb") as f:
+                return f.read()
+        except IOError:
+            return None
+
+    def spill(self, session_id: str, name: str):
+        with self._lock:
+            entry = self._payloads.get(session_id, {}).get(name)
+            if entry is not None:
+                self._spill(session_id, name, entry)
+
+    def mark_exported(self, session_id: str, name: str, exported: bool):
+        # Exported payloads are also held by Streamlit's media file manager
+        # (e.g. behind st.download_button), so usage() counts them twice.
+        with self._lock:
+            entry = self._payloads.get(session_id, {}).get(name)
+            if entry is not None:
+                entry["exported"] = exported
+
+    def retain(self, session_id: str, names: tuple[str, ...]):
+        with self._lock:
+            for name in list(self._payloads.get(session_id, {})):
+                if name not in names:
+                    self._drop(session_id, name)
+
+    def evict_idle(self, idle_timeout: float):
+        cutoff = time.time() - idle_timeout
+        with self._lock:
+            for session_id, last_seen in list(self._last_seen.items()):
+                if last_seen < cutoff:
+                    for name in list(self._payloads.get(session_id, {})):
+                        self._drop(session_id, name)
+                    self._last_seen.pop(session_id, None)
+
+    def usage(self, session_id: Optional[str] = None) -> dict:
+        with self._lock:
+            entries = [
+                (owner, entry)
+                for owner, payloads in self._payloads.items()
+                for entry in payloads.values()
+            ]
+        in_memory = [(owner, e["size"]) for owner, e in entries if e["data"] is not None]
+        in_memory += [(owner, e["size"]) for owner, e in entries if e["exported"]]
+        spilled = [(owner, e["size"]) for owner, e in entries if e["data"] is None]
+        exported = [(owner, e["size"]) for owner, e in entries if e["exported"]]
+        return {
+            "session_memory_bytes": sum(size for owner, size in in_memory if owner == session_id),
+            "session_spilled_bytes": sum(size for owner, size in spilled if owner == session_id),
+            "session_exported_bytes": sum(size for owner, size in exported if owner == session_id),
+            "global_memory_bytes": sum(size for _, size in in_memory),
+            "global_spilled_bytes": sum(size for _, size in spilled),
+            "global_exported_bytes": sum(size for _, size in exported),
+            "sessions": len({owner for owner, _ in entries}),
+            "process_rss_bytes": process_rss_bytes(),
+        }
+
+    def _spill(self, session_id: str, name: str, entry: dict):
+        if entry["data"] is None:
+            return
+        path = os.path.join(self._spill_dir, f"{session_id}-{name}")
+        try:
+            with open(path, "wb") as f:
+                f.write(entry["data"])
+        except IOError:
+            return
+        entry["path"] = path
+        entry["data"] = None
+
+    def _drop(self, session_id: str, name: str):
+        payloads = self._payloads.get(session_id, {})
+        entry = payloads.pop(name, None)
+        if not payloads:
+            self._payloads.pop(session_id, None)
+        if entry and entry["path"]:
+            try:
+                os.remove(entry["path"])
+            except OSError:
+                pass
+
+    def _enforce_budget(self):
+        resident = [
+            (entry["size"], session_id, name, entry)
+            for session_id, payloads in self._payloads.items()
+            for name, entry in payloads.items()
+            if entry["data"] is not None
+        ]
+        total = sum(size for size, *_ in resident)
+        for size, session_id, name, entry in sorted(resident, key=lambda item: item[0], reverse=True):
+            if total <= self.memory_budget:
+                break
+            self._spill(session_id, name, entry)
+            if entry["data"] is None:
+                total -= size
+
+
+@st.cache_resource
+def get_payload_store() -> SessionPayloadStore:
+    return SessionPayloadStore(PAYLOAD_SPILL_THRESHOLD_BYTES, PAYLOAD_MEMORY_BUDGET_BYTES)
+
+
+class MetricsRegistry:
+    # Counters and histograms kept in-process and rendered in the Prometheus
+    # text exposition format, see METRIC_DEFINITIONS for names and buckets.
+
+    def __init__(self, definitions: dict):
+        self.definitions = definitions
+        self._lock = threading.Lock()
+        self._counters: dict[tuple, float] = {}
+        self._histograms: dict[tuple, dict] = {}
+
+    def inc(self, name: str, amount: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name: str, value: float, **labels):
+        buckets = self.definitions[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.setdefault(
+                key, {"buckets": [0] * len(buckets), "sum": 0.0, "count": 0}
+            )
+            for index, upper_bound in enumerate(buckets):
+                if value <= upper_bound:
+                    histogram["buckets"][index] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    def render(self) -> str:
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: dict(value, buckets=list(value["buckets"])) for key, value in self._histograms.items()}
+
+        lines = []
+        for name, (metric_type, help_text, buckets) in self.definitions.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            if metric_type == "counter":
+                for (metric_name, labels), value in sorted(counters.items()):
+                    if metric_name == name:
+                        lines.append(f"{name}{_format_labels(labels)} {float(value)!r}")
+                continue
+
+            for (metric_name, labels), histogram in sorted(histograms.items()):
+                if metric_name != name:
+                    continue
+                for upper_bound, bucket_count in zip(buckets, histogram["buckets"]):
+                    bucket_labels = labels + (("le", f"{upper_bound:g}"),)
+                    lines.append(f"{name}_bucket{_format_labels(bucket_labels)} {bucket_count}")
+                inf_labels = labels + (("le", "+Inf"),)
+                lines.append(f"{name}_bucket{_format_labels(inf_labels)} {histogram['count']}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {float(histogram['sum'])!r}")
+                lines.append(f"{name}_count{_format_labels(labels)} {histogram['count']}")
+        return "\n".join(lines) + "\n"
+
+
+def _format_labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    pairs = []
+    for key, value in labels:
+        escaped = str(value).replace("\\", "\\\\").replace('"', '\\"')
+        pairs.append(f'{key}="{escaped}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+@st.cache_resource
+def get_metrics_registry() -> MetricsRegistry:
+    return MetricsRegistry(METRIC_DEFINITIONS)
+
+
+@st.cache_resource
+def start_metrics_server(port: int) -> Optional[ThreadingHTTPServer]:
+    registry = get_metrics_registry()
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.rstrip("/") != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    try:
+        server = ThreadingHTTPServer(("127.0.0.1", port), MetricsHandler)
+    except OSError:
+        return None
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def write_metrics_file():
+    tmp_path = f"{METRICS_FILE}.tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(get_metrics_registry().render())
+        os.replace(tmp_path, METRICS_FILE)
+    except IOError:
+        pass
+
+
+@contextmanager
+def track_stage(stage: str):
+    # thread_time() is per script thread, i.e. per session run.
+    wall_start = time.perf_counter()
+    cpu_start = time.thread_time()
+    try:
+        yield
+    finally:
+        metrics = get_metrics_registry()
+        metrics.observe("etsy2jtl_stage_duration_seconds", time.perf_counter() - wall_start, stage=stage)
+        metrics.observe("etsy2jtl_stage_cpu_seconds", time.thread_time() - cpu_start, stage=stage)
+        run_profile = st.session_state.get("run_profile")
+        if run_profile is not None:
+            run_profile["stages"].append(
+                (stage, time.perf_counter() - wall_start, time.thread_time() - cpu_start)
+            )
+
+
+def convert_pdf(
+    file_name: str,
+    pdf_bytes: bytes,
+    page_count: int,
+    webhook_url: str,
+    auth_token: str,
+    payload_store: SessionPayloadStore,
+    session_id: str,
+) -> dict:
+    # The processing stage without its UI, so loadtest.py can drive the same
+    # code path. Connection errors and timeouts propagate to the caller.
+    metrics = get_metrics_registry()
+    try:
+        with track_stage("webhook_post"):
+            response = requests.post(
+                webhook_url,
+                files={"data": (file_name, pdf_bytes, "application/pdf")},
+                headers={"x-antsy-token": auth_token},
+                timeout=90,
+                verify=True,
+            )
+    except requests.ConnectionError:
+        metrics.inc("etsy2jtl_webhook_responses_total", outcome="connection_error")
+        raise
+    except requests.Timeout:
+        metrics.inc("etsy2jtl_webhook_responses_total", outcome="timeout")
+        raise
+    except requests.RequestException:
+        metrics.inc("etsy2jtl_webhook_responses_total", outcome="error")
+        raise
+    metrics.inc("etsy2jtl_webhook_responses_total", outcome=str(response.status_code))
+
+    conversion = {"status_code": response.status_code, "order_count": 0, "encoding": None}
+    if response.status_code != 200:
+        return conversion
+
+    conversion["encoding"] = response.encoding or response.apparent_encoding or "utf-8"
+    payload_store.put(session_id, "csv", response.content)
+
+    try:
+        with track_stage("csv_parse"):
+            df_temp = pd.read_csv(StringIO(response.text), sep=";")
+        order_count = len(df_temp)
+    except (pd.errors.ParserError, ValueError):
+        order_count = 0
+
+    if order_count <= 0:
+        return conversion
+
+    with track_stage("update_global_stats"):
+        update_global_stats(order_count)
+    with track_stage("warehouse_append"):
+        append_conversion_to_warehouse(df_temp, file_name, len(pdf_bytes), len(response.content))
+    metrics.observe("etsy2jtl_conversion_pages", page_count)
+    metrics.observe("etsy2jtl_conversion_pdf_bytes", len(pdf_bytes))
+    metrics.observe("etsy2jtl_conversion_orders", order_count)
+
+    conversion["order_count"] = order_count
+    return conversion